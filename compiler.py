@@ -1,183 +1,488 @@
+import os
 import sys
-from ast import *
+import marshal
+import pickle
+import tempfile
+from ast import (
+    AST, Assign, BinOp, BitAnd, BitOr, Call, Constant, FunctionDef, Load, LShift, Module, Name,
+    Return, RShift, Store, Tuple, arg, expr, expr_context, fix_missing_locations,
+    iter_child_nodes, parse, unparse,
+)
+from hashlib import blake2b
+from itertools import count
+from importlib.util import MAGIC_NUMBER, module_from_spec, spec_from_file_location
 from pprint import pprint
-from graphlib import TopologicalSorter
-from types import SimpleNamespace as namespace
+from textwrap import indent
+from types import CodeType, SimpleNamespace as namespace
+from typing import Any, Callable, Final, Optional, Sequence
 
-class StateTracker(NodeVisitor):
-    def __init__(self):
-        super().__init__()
-        self.parts = {}
-        self.graph = TopologicalSorter()
+# graphlib2 is a drop-in, C-accelerated replacement for graphlib
+try:
+    from graphlib2 import TopologicalSorter  # type: ignore[import-not-found]
+except ImportError:
+    from graphlib import TopologicalSorter  # type: ignore[assignment]
 
-    def visit_FunctionDef(self, node):
+try:
+    import pyximport  # type: ignore
+except ImportError:
+    pyximport = None
+
+# A part's analysis: its args, state, dependencies and returns
+Part = dict[str, Any]
+
+# Bump whenever the generated code changes so stale cache entries are ignored
+CACHE_VERSION: Final = 7
+# Safety limit on runs of a circuit before its outputs settle
+MAX_ITERATIONS: Final = 100
+# Widest state that still fits a signed 64-bit int, for the Numba and Cython backends
+WORD_BITS: Final = 63
+# Scripts with at least this many parts are worth compiling with Cython
+NATIVE_MIN_PARTS: Final = 16
+
+# Shared by every rewrite; compile() only reads nodes, so one of each will do
+STATE_LOAD: Final = Name(id="state", ctx=Load())
+STATE_STORE: Final = Name(id="state", ctx=Store())
+ZERO: Final = Constant(value=0)
+
+class StateTracker:
+    func: str
+    args: tuple[str, ...]
+    args_set: frozenset[str]
+    returns: tuple[str, ...]
+    vars: set[str]
+    deps: list[str]
+
+    def __init__(self) -> None:
+        self.parts: dict[str, Part] = {}
+        self.graph: TopologicalSorter[str] = TopologicalSorter()
+        # Handlers return the children to walk into, or None for all of them
+        self._dispatch: dict[type, Callable[[Any], Optional[Sequence[AST]]]] = {
+            FunctionDef: self._on_funcdef,
+            Name: self._on_name,
+            Call: self._on_call,
+        }
+
+    def visit(self, *nodes: AST) -> None:
+        # Walk each node and its children, in order
+        stack = list(reversed(nodes))
+        while stack:
+            node = stack.pop()
+            handler = self._dispatch.get(type(node))
+            children: Optional[Sequence[AST]] = handler(node) if handler else None
+            if children is None:
+                children = list(iter_child_nodes(node))
+            # Push in reverse so nodes are visited in source order
+            stack.extend(reversed(children))
+
+    def _on_funcdef(self, node: FunctionDef) -> Sequence[AST]:
         self.func = node.name
         self.args = tuple(arg.arg for arg in node.args.args)
+        self.args_set = frozenset(self.args)
         self.returns = ()
         self.vars = set()
         self.deps = []
 
         if isinstance(node.returns, Tuple):
-            self.returns = tuple(name.id for name in node.returns.elts)
+            self.returns = tuple(name.id for name in node.returns.elts)  # type: ignore[attr-defined]
         else:
-            self.returns = (node.returns.id,)
+            self.returns = (node.returns.id,)  # type: ignore[union-attr]
 
-        for nd in node.body:
-            self.generic_visit(nd)
+        # Register every part, so ones without calls are analyzed too
+        self.graph.add(node.name)
+        # Walk the body only, in one pass; the return annotation names aren't state
+        self.visit(*node.body)
 
         self.parts[node.name] = {
             "args": self.args,
             "state": tuple(sorted(self.vars)),
             "deps": self.deps,
             "dep_state": (),
+            "dep_sizes": (),
+            "state_size": len(self.vars),
             "returns": self.returns,
             "stateful": bool(self.vars),
         }
+        return ()
 
-    def visit_Name(self, node):
-        if node.id not in self.args and isinstance(node.ctx, Load):
+    def _on_name(self, node: Name) -> Sequence[AST]:
+        if node.id not in self.args_set and isinstance(node.ctx, Load):
             self.vars.add(node.id)
-        return node
-
-    def visit_Call(self, node):
-        self.deps.append(node.func.id)
-        self.graph.add(self.func, node.func.id)
-        for nd in node.args:
-            self.visit(nd)
-        return node
+        return ()
+
+    def _on_call(self, node: Call) -> Sequence[AST]:
+        callee: str = node.func.id  # type: ignore[attr-defined]
+        self.deps.append(callee)
+        self.graph.add(self.func, callee)
+        # Only the arguments; the called part's name is not a state variable
+        return node.args
     
-    def analyze(self):
-        n = 0
+    def analyze(self) -> None:
+        counter = count()
+        # Names of the stateful parts, grown as dependents pick up state below
+        stateful = {name for name, part in self.parts.items() if part["stateful"]}
         # Iterate over the parts in topological order
         for part_name in self.graph.static_order():
             part = self.parts[part_name]
-            sub_states = []
-            # Iterate over the dependencies of the part
-            for dep_name in part["deps"]:
-                dep = self.parts[dep_name]
-                # If the dependency is stateful, add a new state variable
-                if dep["stateful"]:
-                    # Generate a unique state variable name based on the dependency name
-                    dep_id = f"_{dep_name}_{n}"
-                    sub_states.append(dep_id)
-                    n += 1
-                # Store the list of state variables for the part's dependencies
-                part["dep_state"] = tuple(sub_states)
+            deps = [dep_name for dep_name in part["deps"] if dep_name in stateful]
+            # Generate a unique state variable for each stateful dependency
+            part["dep_state"] = tuple(f"_{dep_name}_{next(counter)}" for dep_name in deps)
+            # Each dependency's state is a bit field of this part's state
+            part["dep_sizes"] = tuple(self.parts[dep_name]["state_size"] for dep_name in deps)
+            part["state_size"] = len(part["state"]) + sum(part["dep_sizes"])
             # If the part has state or dependencies with state, mark it as stateful
             if part["state"] or part["dep_state"]:
                 part["stateful"] = True
+                stateful.add(part_name)
 
-class RewriteDeclarations(NodeTransformer):
-    def __init__(self, parts):
-        super().__init__()
+class RewriteDeclarations:
+    def __init__(self, parts: dict[str, Part]) -> None:
         self.parts = parts
 
-    def _unpack_state(self, vars, parts):
-        # Generate an assign statement to unpack the state variables
-        state_vars = ", ".join(vars + parts)
-        default_vals = ["0"] * len(vars) + ["None"] * len(parts)
-        stmt = f"{state_vars} = state if state else ({', '.join(default_vals)})"
-        return parse(stmt).body[0]
+    def visit(self, tree: Module) -> None:
+        # Only top-level definitions are parts; their statements, including
+        # nested ones, are rewritten by _rewrite_function
+        for node in tree.body:
+            if isinstance(node, FunctionDef):
+                self._rewrite_function(node)
+        # Fill in locations for every generated node in a single pass
+        fix_missing_locations(tree)
 
-    def _pack_state(self, vars, parts):
-        # Generate a return statement to re-pack the state variables
-        state_vars = ", ".join(vars + parts)
-        return parse(f"state = ({state_vars})").body[0]
+    def _names(self, names: Sequence[str], ctx: expr_context) -> expr:
+        # A single name stands alone, as it would in "a = (b)"
+        nodes: list[expr] = [Name(id=name, ctx=ctx) for name in names]
+        return nodes[0] if len(nodes) == 1 else Tuple(elts=nodes, ctx=ctx)
 
-    def _stateful_return(self, returns):
-        # Generate a return statement to return the output and state
-        return_vars = ", ".join(returns)
-        return parse(f"return ({return_vars}), state").body[0]
+    def _bits(self, offset: int, size: int) -> expr:
+        # Generate "state >> offset & mask" to read a field of the state
+        value: expr = STATE_LOAD
+        if offset:
+            value = BinOp(left=value, op=RShift(), right=Constant(value=offset))
+        return BinOp(left=value, op=BitAnd(), right=Constant(value=(1 << size) - 1))
 
-    def visit_FunctionDef(self, node):
-        self.part = self.parts[node.name]
-        self.calls = list(self.part["dep_state"])
+    def _fields(self, vars: tuple[str, ...], sizes: tuple[int, ...]) -> list[tuple[int, int]]:
+        # The offset and size of each field of the state: a bit for each
+        # state variable, then each stateful part's state in turn
+        fields = [(i, 1) for i in range(len(vars))]
+        offset = len(vars)
+        for size in sizes:
+            fields.append((offset, size))
+            offset += size
+        return fields
 
-        self.generic_visit(node)
+    def _unpack_state(self, vars: tuple[str, ...], parts: tuple[str, ...], sizes: tuple[int, ...]) -> Assign:
+        # Generate an assign statement to read each state variable's bit, and
+        # the bits of each stateful part's state
+        values = [self._bits(offset, size) for offset, size in self._fields(vars, sizes)]
+        return Assign(
+            targets=[self._names(vars + parts, Store())],
+            value=values[0] if len(values) == 1 else Tuple(elts=values, ctx=Load()),
+        )
+
+    def _pack_state(self, vars: tuple[str, ...], parts: tuple[str, ...], sizes: tuple[int, ...]) -> Assign:
+        # Generate an assign statement to pack the state back into one integer
+        value: Optional[expr] = None
+        for name, (field_offset, size) in zip(vars + parts, self._fields(vars, sizes)):
+            # Mask each field, so a value outside it, like ~a, can't spill
+            # into its neighbours
+            field: expr = BinOp(
+                left=Name(id=name, ctx=Load()), op=BitAnd(), right=Constant(value=(1 << size) - 1)
+            )
+            if field_offset:
+                field = BinOp(left=field, op=LShift(), right=Constant(value=field_offset))
+            value = field if value is None else BinOp(left=value, op=BitOr(), right=field)
+        assert value is not None
+        return Assign(targets=[STATE_STORE], value=value)
+
+    def _stateful_return(self, returns: tuple[str, ...]) -> Return:
+        # Generate a return statement to return the output and state
+        return Return(
+            value=Tuple(elts=[self._names(returns, Load()), STATE_LOAD], ctx=Load())
+        )
+
+    def _rewrite_function(self, node: FunctionDef) -> None:
+        p = namespace(**self.parts[node.name])
+        # State variables for the stateful calls, in the order they are made
+        calls = iter(p.dep_state)
+        # Walk every node in source order, exactly as StateTracker does, so
+        # each stateful call gets the state variable recorded for it
+        assigns: dict[int, Assign] = {}
+        stack: list[AST] = list(reversed(node.body))
+        while stack:
+            nd = stack.pop()
+            if isinstance(nd, Assign) and isinstance(nd.value, Call):
+                assigns[id(nd.value)] = nd
+            elif isinstance(nd, Call):
+                callee: str = nd.func.id  # type: ignore[attr-defined]
+                if self.parts[callee]["stateful"]:
+                    # The state has to come back out through an assignment
+                    if id(nd) not in assigns:
+                        raise SyntaxError(f"{node.name}: call to stateful part {callee} is not assigned")
+                    self._thread_state(assigns[id(nd)], next(calls))
+                # Only the arguments, as StateTracker visits them
+                stack.extend(reversed(nd.args))
+                continue
+            stack.extend(reversed(list(iter_child_nodes(nd))))
+        # Every recorded call has been threaded, and no more
+        assert next(calls, None) is None
 
-        p = namespace(self.parts[node.name])
         if p.stateful:
             # Add state argument to function
             node.args.args.append(arg(arg="state"))
-            # Add default value for state argument
-            node.args.defaults.append(Constant(value=None))
-            # Unpack state argument at the beginning of the function
-            pack = self._pack_state(p.state, p.dep_state)
+            # Add default value for state argument; all bits start cleared
+            node.args.defaults.append(ZERO)
             # Pack state argument at the end of the function
-            unpack = self._unpack_state(p.state, p.dep_state)
+            pack = self._pack_state(p.state, p.dep_state, p.dep_sizes)
+            # Unpack state argument at the beginning of the function
+            unpack = self._unpack_state(p.state, p.dep_state, p.dep_sizes)
             # Add unpack and pack to the function body
-            node.body = [unpack] + node.body + [pack]
+            node.body = [unpack, *node.body, pack]
 
         # Delete the "return type" of the function
         if node.returns:
             return_value = node.returns
-            del node.returns
+            del node.returns  # type: ignore[misc]
 
             if p.stateful:
                 # Add the state variable to the return statement
                 return_node = self._stateful_return(p.returns)
             else:
                 # Add the return statement to the end of the function body
-                return_node = Return(value=return_value)
+                return_node = Return(value=return_value)  # type: ignore[assignment]
 
             # Add the return statement to the end of the function body
             node.body.append(return_node)
 
-        fix_missing_locations(node)
-        return node
-    
-    def visit_Assign(self, node):
-        self.generic_visit(node)
-
-        if isinstance(node.value, Call):
-            targets, call = node.targets, node.value
-            if self.parts[call.func.id].get("state"):
-                # Get the next state variable
-                part_state = self.calls.pop(0)
-                # Add the next state variable to the function return assignment
-                original_target = targets[0]
-                targets[0] = Tuple(elts=[original_target, Name(id=part_state, ctx=Store())], ctx=Store())
-                # Add the next state variable to the end of the function call
-                call.args.append(Name(id=part_state, ctx=Load()))
-
-        return node
-
-def parse_script(fn_def):
+    def _thread_state(self, node: Assign, part_state: str) -> None:
+        targets, call = node.targets, node.value
+        assert isinstance(call, Call)
+        # Add the state variable to the function return assignment
+        original_target = targets[0]
+        targets[0] = Tuple(elts=[original_target, Name(id=part_state, ctx=Store())], ctx=Store())
+        # Add the state variable to the end of the function call
+        call.args.append(Name(id=part_state, ctx=Load()))
+
+def _cache_key(fn_def: str) -> str:
+    # Key on the compiler version and bytecode format as well as the source
+    key = blake2b(fn_def.encode())
+    key.update(MAGIC_NUMBER + CACHE_VERSION.to_bytes(4, "little"))
+    return key.hexdigest()
+
+def _cache_dir() -> str:
+    # Looked up on each use rather than fixed at import, so it follows
+    # XDG_CACHE_HOME even where mypyc would inline a constant
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "gatecrasher")
+
+def _cache_paths(fn_def: str) -> tuple[str, str]:
+    base = os.path.join(_cache_dir(), _cache_key(fn_def))
+    return base + ".pyc", base + ".parts"
+
+def _load_cached(fn_def: str) -> Optional[tuple[dict[str, Part], CodeType]]:
+    code_path, parts_path = _cache_paths(fn_def)
+    try:
+        with open(parts_path, "rb") as f:
+            parts = pickle.load(f)
+        with open(code_path, "rb") as f:
+            code = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+        return None
+    return parts, code
+
+def _write_atomic(path: str, data: bytes) -> None:
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def _store_cached(fn_def: str, parts: dict[str, Part], code: CodeType) -> None:
+    code_path, parts_path = _cache_paths(fn_def)
+    try:
+        os.makedirs(os.path.dirname(parts_path), exist_ok=True)
+        # Write the parts first so a code file always has its parts alongside
+        _write_atomic(parts_path, pickle.dumps(parts))
+        _write_atomic(code_path, marshal.dumps(code))
+    except OSError:
+        # The cache is an optimization; an unwritable cache dir is not fatal
+        pass
+
+def parse_script(
+    fn_def: str, use_cache: bool = True
+) -> tuple[Optional[Module], dict[str, Part], CodeType]:
+    # On a cache hit the AST is never built, so the returned tree is None
+    if use_cache:
+        cached = _load_cached(fn_def)
+        if cached:
+            parts, code = cached
+            return None, parts, code
+
     tree = parse(fn_def)
     tracker = StateTracker()
     tracker.visit(tree)
     tracker.analyze()
     rewriter = RewriteDeclarations(tracker.parts)
     rewriter.visit(tree)
-    return tree, tracker.parts
-
-def exec_tree(tree, parts):
-    defs = {"__builtins__": {}}
     code = compile(tree, filename="<ast>", mode="exec")
+    if use_cache:
+        _store_cached(fn_def, tracker.parts, code)
+    return tree, tracker.parts, code
+
+def compile_script(fn_def: str) -> tuple[CodeType, dict[str, Part]]:
+    # Compile straight to a code object, without keeping the tree alive
+    _, parts, code = parse_script(fn_def)
+    return code, parts
+
+def numba_errors() -> tuple[type[Exception], ...]:
+    # Raised when a circuit fails to compile. Numba is slow to import, so it
+    # is only imported when JIT compiling; until then nothing can raise these
+    # and an empty tuple, which catches nothing, will do
+    if "numba" not in sys.modules:
+        return ()
+    from numba.core.errors import NumbaError  # type: ignore[import-not-found]
+    return (NumbaError,)
+
+def exec_tree(
+    tree: Optional[Module], parts: dict[str, Part], code: Optional[CodeType] = None, jit: bool = False
+) -> dict[str, Any]:
+    defs: dict[str, Any] = {"__builtins__": {}}
+    if code is None:
+        assert tree is not None
+        code = compile(tree, filename="<ast>", mode="exec")
     exec(code, defs)
-    # Attach output names to each function
+    if jit:
+        import numba  # type: ignore[import-not-found]
     for name, part in parts.items():
         if name in defs:
-            defs[name].output_names = part["returns"]
+            # State wider than int64 stays in Python; only parts calling it are
+            # wider still, so no compiled part ever calls back into Python
+            if jit and part["state_size"] <= WORD_BITS:
+                # Compile lazily in nopython mode; calls between parts resolve
+                # through defs, which only holds dispatchers by the first call
+                defs[name] = numba.njit(defs[name])
+    _annotate(defs, parts)
     return defs
 
-def build(fn):
-    state = None
-    def wrapper(*args):
+def _typed_pyx(tree: Module, parts: dict[str, Part]) -> str:
+    # Render the rewritten tree as Cython, with C types for inputs and state
+    lines = ["# cython: boundscheck=False, wraparound=False", ""]
+    for node in tree.body:
+        if not isinstance(node, FunctionDef):
+            lines.append(unparse(node))
+            continue
+        part = parts[node.name]
+        # State too wide for a machine word stays a Python int
+        word = "unsigned long long " if part["state_size"] <= WORD_BITS else ""
+        params = [f"int {name}" for name in part["args"]]
+        if part["stateful"]:
+            params.append(f"{word}state=0")
+        lines.append(f"def {node.name}({', '.join(params)}):")
+        if part["stateful"] and word:
+            # A part's own state may hold any value, like ~a, until it is
+            # masked when packed, so it has to be signed
+            if part["state"]:
+                lines.append(f"    cdef long long {', '.join(part['state'])}")
+            # Sub-part states are packed words, never negative; share the
+            # state's type, so packing never shifts out of range
+            if part["dep_state"]:
+                lines.append(f"    cdef {word}{', '.join(part['dep_state'])}")
+        lines.extend(indent(unparse(stmt), "    ") for stmt in node.body)
+        lines.append("")
+    return "\n".join(lines)
+
+def exec_native(fn_def: str, tree: Optional[Module], parts: dict[str, Part]) -> dict[str, Any]:
+    # Build the script as a Cython extension module, reusing a cached build
+    name = f"gatecrasher_{_cache_key(fn_def)[:32]}"
+    cache_dir = _cache_dir()
+    pyx_path = os.path.join(cache_dir, name + ".pyx")
+    build_dir = os.path.join(cache_dir, "build")
+    if not os.path.exists(pyx_path):
+        if tree is None:
+            tree, parts, _ = parse_script(fn_def, use_cache=False)
+            assert tree is not None
+        os.makedirs(cache_dir, exist_ok=True)
+        _write_atomic(pyx_path, _typed_pyx(tree, parts).encode())
+
+    # install() sets up the build options build_module relies on; the import
+    # hooks themselves are not needed, since the module is loaded by path
+    pyximport.uninstall(*pyximport.install(build_dir=build_dir, language_level=3))
+    so_path = pyximport.build_module(name, pyx_path, pyxbuild_dir=build_dir, language_level=3)
+    spec = spec_from_file_location(name, so_path)
+    assert spec is not None and spec.loader is not None
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    defs: dict[str, Any] = {"__builtins__": {}}
+    for part_name in parts:
+        defs[part_name] = getattr(module, part_name)
+    _annotate(defs, parts)
+    return defs
+
+def _annotate(defs: dict[str, Any], parts: dict[str, Part]) -> None:
+    for name, part in parts.items():
+        if name in defs:
+            # Attach input and output names to each function
+            defs[name].input_names = part["args"]
+            defs[name].output_names = part["returns"]
+            defs[name].state_size = part["state_size"]
+
+def build(fn: Any) -> Callable[..., Any]:
+    state = 0
+    def wrapper(*args: int) -> Any:
         nonlocal state
-        args = args + (state,)
-        output, state = fn(*args)
+        output, state = fn(*args, state)
         return output
     return wrapper
 
+def driver(fn: Any, jit: bool = False) -> Callable[..., tuple[list[Any], int]]:
+    # Generate a loop specialized to the circuit's inputs that runs it until
+    # its outputs settle, returning each distinct output and the final state
+    # Drivers are cached per mode, so asking for the other one builds it
+    drivers = fn.__dict__.setdefault("drivers", {})
+    if jit in drivers:
+        return drivers[jit]
+    # Positional names avoid clashing with the driver's own variables
+    params = [f"_{i}" for i in range(len(fn.input_names))]
+    args = ", ".join(params + ["state"])
+    if fn.state_size:
+        src = f"""
+def drive({args}):
+    prev, state = fn({args})
+    outputs = [prev]
+    for _ in range({MAX_ITERATIONS - 1}):
+        out, state = fn({args})
+        if out == prev:
+            break
+        outputs.append(out)
+        prev = out
+    return outputs, state
+"""
+    else:
+        # Without state the outputs settle on the first run
+        src = f"""
+def drive({args}):
+    return [fn({", ".join(params)})], state
+"""
+    defs: dict[str, Any] = {"__builtins__": {"range": range}, "fn": fn}
+    exec(src, defs)
+    if jit:
+        import numba  # type: ignore[import-not-found]
+        drivers[jit] = numba.njit(defs["drive"])
+    else:
+        drivers[jit] = defs["drive"]
+    return drivers[jit]
+
 if __name__ == "__main__":
     with open(sys.argv[1]) as f:
         fn_def = f.read()
     print("\nTransformed Python code:\n" + "-"*30 + "\n")
-    tree, parts = parse_script(fn_def)
+    tree, parts, code = parse_script(fn_def, use_cache=False)
+    assert tree is not None
     print(unparse(tree))
 
     print("\nCompiled Python functions:\n" + "-"*30 + "\n")
-    defs = exec_tree(tree, parts)
+    defs = exec_tree(tree, parts, code)
     pprint(tuple(k for k in defs.keys() if not k.startswith("__")))
     print("\n")
@@ -2,24 +2,30 @@
 
 import sys
 import code
-import inspect
 import compiler
 import readline
 import atexit
 import os
+from importlib.util import find_spec
 
 class CircuitConsole(code.InteractiveConsole):
-    def __init__(self, circuits):
+    def __init__(self, circuits, jitted=None, native=None):
         # Add help and list to the local namespace
         circuits['help'] = self.help
         circuits['?'] = self.help
         circuits['list'] = self.list_circuits
         
         super().__init__(locals=circuits)
+        # Numba-compiled versions of the circuits, used when available
+        self.jitted = jitted or {}
+        # Cython-built versions of the circuits, used when available
+        self.native = native or {}
         self.current_circuit = None
+        self.current_driver = None
         self.current_func = None
+        self.verbose = False
         self.inputs = {}
-        self.state = None
+        self.state = 0
         
         # Set up readline history
         self.histfile = os.path.join(os.getcwd(), ".crash_history")
@@ -44,12 +50,14 @@ class CircuitConsole(code.InteractiveConsole):
 Circuit REPL Help:
 -----------------
 @<name>     Select a circuit by name (e.g., @and_gate)
+@<name>!    Select a circuit and show each output until it settles
 <input>     Toggle an input value (0/1) for the current circuit
 <enter>     Re-run the current circuit with existing inputs
 list()      Display all available circuits
 
 Examples:
     @nand       Select the nand circuit
+    @sr_latch!  Select the sr_latch circuit, showing every step
     a           Toggle input 'a'
     b           Toggle input 'b'
     <enter>     Re-run with current inputs
@@ -70,20 +78,30 @@ Tips:
             return False
         elif not source and self.current_circuit:
             # Re-run circuit with current inputs on empty input
-            _ = self._trigger_circuit()
+            _ = self._trigger_circuit(self.verbose)
             return False
         elif source.startswith("@"):
             func_name = source[1:]
-            if func_name in self.locals:
+            # A trailing "!" shows the intermediate outputs as well
+            verbose = func_name.endswith("!")
+            func_name = func_name.removesuffix("!")
+            # Input names were recorded at compile time, excluding 'state';
+            # anything else in the namespace, like help, has none
+            input_names = getattr(self.locals.get(func_name), "input_names", None)
+            if input_names is not None:
                 # Get the original function object
                 func = self.locals[func_name]
-                # Get input argument names from signature, excluding 'state'
-                sig = inspect.signature(func)
-                self.inputs = {name: 0 for name in sig.parameters if name != 'state'}
-                # Store the raw circuit function
-                self.current_circuit = func
-                self.state = None
+                self.inputs = dict.fromkeys(input_names, 0)
+                # Store the circuit function, preferring a compiled one
+                self.current_circuit = self.native.get(func_name) or self.jitted.get(func_name, func)
+                # All state bits start cleared
+                self.state = 0
+                # Get the fixed-point loop generated for this circuit; parts
+                # with state wider than a machine word were never JIT-compiled
+                jit = func_name in self.jitted and func.state_size <= compiler.WORD_BITS
+                self.current_driver = compiler.driver(self.current_circuit, jit=jit)
                 self.current_func = func_name
+                self.verbose = verbose
                 # Show initial state
                 self._display_state()
             else:
@@ -95,48 +113,59 @@ Tips:
                 # Toggle the input
                 self.inputs[source] = 1 - self.inputs[source]
                 # Run circuit with current inputs - outputs handled in _trigger_circuit
-                _ = self._trigger_circuit()
+                _ = self._trigger_circuit(self.verbose)
             else:
                 print("No circuit selected. Use @<func> to select a circuit.")
             return False
             
         return super().runsource(source, filename, symbol)
     
-    def _trigger_circuit(self):
-        input_values = [self.inputs[name] for name in self.inputs]
-        MAX_ITERATIONS = 100  # Safety limit to prevent infinite loops
-        iteration = 0
-        prev_result = None
+    def _trigger_circuit(self, verbose=False):
+        # Run the circuit until its outputs settle
+        outputs, self.state = self._drive([*self.inputs.values(), self.state])
+        result = outputs[-1]
 
-        while iteration < MAX_ITERATIONS:
-            result, self.state = self.current_circuit(*(input_values + [self.state]))
-            
+        output_names = self.locals[self.current_func].output_names
+        is_tuple = len(output_names) > 1
+        inputs_str = "{" + ", ".join(f"{k}={v}" for k, v in self.inputs.items()) + "}"
+        fmt = "{}={}".format
+        if not verbose:
+            # Only the settled outputs
+            outputs = [result]
+
+        for iteration, values in enumerate(outputs):
             # Format outputs
-            func = self.locals[self.current_func]
-            if isinstance(result, tuple):
-                outputs_str = ", ".join(f"{name}={value}" for name, value in zip(func.output_names, result))
+            if is_tuple:
+                outputs_str = ", ".join(map(fmt, output_names, values))
             else:
-                outputs_str = f"{func.output_names[0]}={result}"
-            
-            # Check for stabilization before printing
-            if result == prev_result:
-                break
+                outputs_str = fmt(output_names[0], values)
 
-            # Display with inputs only on first iteration, subsequent outputs indented
+            # Display with inputs only on first iteration, subsequent outputs
+            # indented to line up under the first arrow
             if iteration == 0:
-                inputs_str = ", ".join(f"{k}={v}" for k, v in self.inputs.items())
-                full_line = f"{{{inputs_str}}} -> {{{outputs_str}}}"
-                print(full_line)
-                # Calculate padding based on actual input length
-                self.arrow_padding = len(full_line) - len(f" -> {{{outputs_str}}}")
+                print(f"{inputs_str} -> {{{outputs_str}}}")
             else:
-                print(f"{' ' * self.arrow_padding} -> {{{outputs_str}}}")
-
-            prev_result = result
-            iteration += 1
+                print(f"{' ' * len(inputs_str)} -> {{{outputs_str}}}")
 
         return result
     
+    def _drive(self, args):
+        try:
+            return self.current_driver(*args)
+        except compiler.numba_errors():
+            # Not every circuit types in nopython mode; fall back to Python
+            self.jitted.pop(self.current_func, None)
+        except Exception as e:
+            if self.current_func not in self.native:
+                raise
+            # The C types of the native build can reject values Python
+            # takes; fall back to Python
+            print(f"Native circuit failed, running in Python: {e}")
+            self.native.pop(self.current_func)
+        self.current_circuit = self.locals[self.current_func]
+        self.current_driver = compiler.driver(self.current_circuit)
+        return self.current_driver(*args)
+
     def _display_state(self):
         print(f"Loaded: {self.current_func}")
         inputs_str = ", ".join(f"{k}={v}" for k, v in self.inputs.items())
@@ -149,12 +178,27 @@ def main():
         
     # Load and compile the circuit
     with open(sys.argv[1]) as f:
-        code = f.read()
-    tree, parts = compiler.parse_script(code)
-    circuits = compiler.exec_tree(tree, parts)
+        source = f.read()
+    code, parts = compiler.compile_script(source)
+    native = jitted = None
+    # Numba runs circuits fastest, so Cython is only used when it is missing
+    has_numba = find_spec("numba") is not None
+    if not has_numba and compiler.pyximport and len(parts) >= compiler.NATIVE_MIN_PARTS:
+        # Large scripts are compiled to a native extension instead
+        try:
+            native = compiler.exec_native(source, None, parts)
+        except Exception as e:
+            # Cython and the C compiler each raise their own CompileError, and
+            # pyximport wraps other failures in ImportError; the Python
+            # functions work regardless
+            print(f"Native build failed, running in Python: {e}")
+    # The Python functions are kept as a fallback for the compiled ones
+    circuits = compiler.exec_tree(None, parts, code)
+    if has_numba:
+        jitted = compiler.exec_tree(None, parts, code, jit=True)
     
     # Start the interactive console with help text
-    console = CircuitConsole(circuits)
+    console = CircuitConsole(circuits, jitted, native)
     console.help()
     console.interact(banner="")
 
@@ -0,0 +1,19 @@
+# Build a wheel with compiler.py compiled as a native extension by mypyc:
+#
+#     pip wheel .
+#
+# pip installs mypy, which ships mypyc, into the isolated build environment
+# from pyproject.toml; it is not needed at run time. console.py imports the
+# compiled module in place of the pure Python one.
+from setuptools import setup
+
+try:
+    from mypyc.build import mypycify
+except ImportError:
+    raise SystemExit("Building requires mypyc: pip install mypy")
+
+setup(
+    name="gatecrasher",
+    py_modules=["console"],
+    ext_modules=mypycify(["compiler.py"]),
+)
@@ -0,0 +1,129 @@
+import os
+import tempfile
+import unittest
+from importlib.util import find_spec
+from unittest import mock
+
+import compiler
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# A set/hold latch: once set, q stays 1
+LATCH = """
+def latch(s) -> q:
+    q = s | q
+"""
+
+def run(src, name, inputs, use_cache=False):
+    # Feed each set of inputs to a part in turn, returning its outputs
+    tree, parts, code = compiler.parse_script(src, use_cache=use_cache)
+    fn = compiler.exec_tree(tree, parts, code)[name]
+    state, outputs = 0, []
+    for args in inputs:
+        output, state = fn(*args, state)
+        outputs.append(output)
+    return parts, outputs
+
+def drive(fn, inputs, jit=False):
+    # Settle a circuit on each set of inputs in turn, through its driver
+    settle = compiler.driver(fn, jit=jit)
+    state, results = 0, []
+    for args in inputs:
+        outputs, state = settle(*args, state)
+        results.append((list(outputs), state))
+    return results
+
+def flip_flop():
+    with open(os.path.join(HERE, "d_flip_flop.crash")) as f:
+        return f.read()
+
+class RewriteDeclarationsTest(unittest.TestCase):
+    def test_stateful_call_in_if_else(self):
+        src = LATCH + """
+def pick(s, sel) -> q:
+    if sel:
+        q = latch(s)
+    else:
+        q = latch(s)
+"""
+        parts, outputs = run(src, "pick", [(1, 1), (0, 1), (0, 0), (1, 0), (0, 0)])
+        # Each branch has a latch of its own
+        self.assertEqual(len(parts["pick"]["dep_state"]), 2)
+        self.assertEqual(outputs, [1, 1, 0, 1, 1])
+
+    def test_nested_stateful_call_is_rejected(self):
+        src = LATCH + """
+def twice(s) -> q:
+    q = latch(latch(s))
+"""
+        with self.assertRaises(SyntaxError):
+            compiler.parse_script(src, use_cache=False)
+
+    def test_stateful_through_dependency(self):
+        src = LATCH + """
+def wrap(s) -> q:
+    q = latch(s)
+"""
+        parts, outputs = run(src, "wrap", [(0,), (1,), (0,)])
+        self.assertEqual(parts["wrap"]["state"], ())
+        self.assertTrue(parts["wrap"]["stateful"])
+        self.assertEqual(outputs, [0, 1, 1])
+
+class CacheTest(unittest.TestCase):
+    def test_cache_hit_matches_miss(self):
+        src = flip_flop()
+        inputs = [(1, 0), (1, 1), (1, 0), (0, 0), (0, 1), (0, 0)]
+        with tempfile.TemporaryDirectory() as cache_home, mock.patch.dict(os.environ, {"XDG_CACHE_HOME": cache_home}):
+            miss = run(src, "d_flip_flop", inputs, use_cache=True)
+            tree, _, _ = compiler.parse_script(src)
+            # The second parse is served from the cache, without a tree
+            self.assertIsNone(tree)
+            hit = run(src, "d_flip_flop", inputs, use_cache=True)
+        self.assertEqual(hit, miss)
+
+class DriverTest(unittest.TestCase):
+    inputs = [(1, 0), (1, 1), (1, 0), (0, 0), (0, 1), (0, 0)]
+
+    def setUp(self):
+        self.code, self.parts = compiler.compile_script(flip_flop())
+
+    def test_python_driver(self):
+        fn = compiler.exec_tree(None, self.parts, self.code)["d_flip_flop"]
+        # Every distinct output on the way to settling, with the final state
+        self.assertEqual(drive(fn, self.inputs), [
+            ([1], 4), ([1], 6), ([1], 4), ([1], 4), ([1, 0], 9), ([0], 8),
+        ])
+
+    @unittest.skipIf(find_spec("numba") is None, "Numba is not installed")
+    def test_jit_driver(self):
+        fn = compiler.exec_tree(None, self.parts, self.code, jit=True)["d_flip_flop"]
+        self.assertEqual(drive(fn, self.inputs, jit=True), drive(fn, self.inputs))
+        # Each mode builds and caches a driver of its own
+        self.assertIsNot(compiler.driver(fn), compiler.driver(fn, jit=True))
+        self.assertIs(compiler.driver(fn, jit=True), compiler.driver(fn, jit=True))
+
+@unittest.skipIf(compiler.pyximport is None, "Cython is not installed")
+class NativeTest(unittest.TestCase):
+    def test_native_matches_python(self):
+        # hold stores a negative value in its own state
+        src = flip_flop() + """
+def neg(a) -> b:
+    b = ~a
+
+def hold(a) -> q:
+    q = r
+    r = neg(a)
+"""
+        with tempfile.TemporaryDirectory() as cache_home, mock.patch.dict(os.environ, {"XDG_CACHE_HOME": cache_home}):
+            code, parts = compiler.compile_script(src)
+            native = compiler.exec_native(src, None, parts)
+        python = compiler.exec_tree(None, parts, code)
+        for name, inputs in [
+            ("d_flip_flop", [(1, 0), (1, 1), (1, 0), (0, 0), (0, 1), (0, 0)]),
+            ("hold", [(0,), (1,), (0,), (1,)]),
+        ]:
+            with self.subTest(name):
+                self.assertEqual(drive(native[name], inputs), drive(python[name], inputs))
+
+if __name__ == "__main__":
+    unittest.main()